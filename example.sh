@@ -22,6 +22,12 @@ cart view --sortby Price
 echo "\n> cart view --sortby Subtotal"
 cart view --sortby Subtotal
 
+echo "\n> cart view --max-price 5 --min-subtotal 10"
+cart view --max-price 5 --min-subtotal 10
+
+echo "\n> cart view --format csv --sortby Subtotal"
+cart view --format csv --sortby Subtotal
+
 echo "\n> cart update_quantity 2 4"
 cart update_quantity 2 4
 
@@ -51,3 +57,6 @@ echo "\n> products view"
 products view
 echo "\n> cart view"
 cart view
+
+echo "\n> cart orders"
+cart orders
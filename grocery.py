@@ -1,14 +1,33 @@
 """
 A command line interface for interacting with a toy shopping cart.
+
+The same operations are available in-process through Session, which keeps the
+cart and product list in memory and writes them back on commit:
+
+    with grocery.Session() as session:
+        product_id = session.store.add('bread', 'loafs', 3.25)
+        session.store.to_cart(product_id, 2)
+        total_cents = session.cart.total()
 """
+import abc
+import asyncio
+import contextlib
+import csv
+import decimal
 import functools
+import glob
+import hashlib
 import json
+import math
+import operator
 import os
 import re
 import time
+import uuid
 
 import click
 import ilock
+import numpy
 
 
 # Putting a data file in the same directory as this file is fairly safe...
@@ -21,47 +40,227 @@ CART_DB_PATH = os.path.join(
 STORE_DB_PATH = os.path.join(
         os.path.dirname(os.path.realpath(__file__)), '.store_products.json'
 )
+# The manifest names the cart and product files making up the current version
+#   of the data. Each commit writes new files next to it, named after the two
+#   paths above with the version number added, and then replaces the manifest.
+MANIFEST_PATH = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), '.grocery_manifest.json'
+)
+# Append-only log of placed orders, one json record per line.
+ORDERS_PATH = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), '.grocery_orders.jsonl'
+)
 HEADER = 'ID,Name,Unit of Measure,Quantity,Price'
+ORDER_HEADER = 'Order ID,Date,Method,Items,Total'
+# Field names used by the machine readable view formats.
+FIELDS = 'id,name,units,quantity,price_cents,subtotal_cents'
+FORMATS = ['table', 'json', 'csv', 'ndjson']
+# Prices are stored as integer cents and quantities as integer thousandths of
+#   a unit so that subtotals and totals are exact.
+QUANTITY_SCALE = 1000
+
+
+def _to_fixed(value, exponent, param_hint=None):
+    '''
+    Convert a decimal number to an integer count of 10 ** -exponent, rounding
+    half up. Infinite and nan values are rejected as a bad param_hint.
+    '''
+    if not math.isfinite(value):
+        raise click.BadParameter('Must be a finite number.',
+          param_hint=param_hint)
+    return int(decimal.Decimal(str(value)).scaleb(exponent).quantize(
+        decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
 
 
-_format_price = '${:,.2f}'.format
+def _to_cents(price, param_hint='price'):
+    return _to_fixed(price, 2, param_hint)
 
 
-def _write_json(data, cart=True):
+def _to_quantity(quantity, param_hint='quantity'):
+    return _to_fixed(quantity, 3, param_hint)
+
+
+def _format_price(cents):
+    return '${:,.2f}'.format(decimal.Decimal(cents).scaleb(-2))
+
+
+def _format_quantity(quantity):
+    return '{:f}'.format(decimal.Decimal(quantity).scaleb(-3).normalize())
+
+
+def _subtotals(prices, quantities):
     '''
-    Read serialized product file from disk.
+    Subtotal in cents of each price (in cents) times quantity (in thousandths
+    of a unit), rounded half up to the nearest cent. Works element-wise on
+    numpy arrays as well as on plain integers.
+    '''
+    return (prices * quantities + QUANTITY_SCALE // 2) // QUANTITY_SCALE
+
+
+def _totals(prices, quantities):
+    '''
+    Compute the subtotal of every line and the grand total in a single
+    vectorized pass. Each line is rounded to the cent before summing so that
+    the grand total always equals the sum of the displayed subtotals.
+    '''
+    dtype = numpy.int64
+    if prices and ((max(prices) * max(quantities) + QUANTITY_SCALE)
+            * len(prices) > numpy.iinfo(numpy.int64).max):
+        # Fall back to exact python integers for amounts which could wrap
+        #   around in 64 bits.
+        dtype = object
+    subtotals = _subtotals(numpy.asarray(prices, dtype=dtype),
+        numpy.asarray(quantities, dtype=dtype))
+    return subtotals, int(subtotals.sum())
+
+
+def _write_json(data, path):
+    '''
+    Write data to path in json serialization, making sure it has reached the
+    disk before returning.
     '''
-    path = CART_DB_PATH
-    if not cart:
-        path = STORE_DB_PATH
     with open(path, 'w') as filehandle:
         json.dump(data, filehandle)
+        filehandle.flush()
+        os.fsync(filehandle.fileno())
 
 
-def _write_cart(data):
-    _write_json(data)
+def _table_name(cart=True):
+    return 'cart' if cart else 'products'
 
 
-def _write_products(data):
-    _write_json(data, False)
+def _read_manifest():
+    '''
+    Read the manifest of the current version. Data written before versioning
+    was introduced is treated as version 0, stored at the unversioned paths.
+    '''
+    if not os.path.isfile(MANIFEST_PATH):
+        return {'version': 0, 'cart': os.path.basename(CART_DB_PATH),
+                'products': os.path.basename(STORE_DB_PATH)}
+    with open(MANIFEST_PATH, 'r') as filehandle:
+        return json.load(filehandle)
 
 
-def _read_json(cart=True):
+def _read_json(cart=True, manifest=None):
     '''
-    Given a dictionary representation of a shopping cart, write it to disk in
-    json serialization.
+    Read the shopping cart or product list from disk, as of the version
+    described by manifest (by default the current one). Raises ConflictError
+    if the files of that version have already been cleaned up.
     '''
-    path = CART_DB_PATH
-    if not cart:
-        path = STORE_DB_PATH
-    # Cart is empty if file doesn't exist.
+    if manifest is None:
+        manifest = _read_manifest()
+    name = manifest[_table_name(cart)]
+    path = os.path.join(os.path.dirname(MANIFEST_PATH), name)
     ret = {}
     if os.path.isfile(path):
         with open(path, 'r') as filehandle:
             ret = json.load(filehandle)
+    elif name not in (os.path.basename(CART_DB_PATH),
+            os.path.basename(STORE_DB_PATH)):
+        # Only the unversioned files may not exist yet, meaning the table is
+        #   empty. A missing versioned file was deleted by _commit after newer
+        #   versions were written.
+        raise ConflictError('The cart or product list was changed by other '
+                'commands while being read, please try again.')
     # Keys are always stored as strings in json so transform them
     #   back to integers.
-    return {int(key): val for key, val in ret.items()}
+    return {int(key): _upgrade_row(val) for key, val in ret.items()}
+
+
+def _commit(manifest, changes):
+    '''
+    Write a new version on top of the one described by manifest. changes maps
+    cart (True) or product list (False) to its new contents; both files are
+    written in full before the manifest is atomically replaced, so readers
+    see either all or none of the changes. Files no longer referenced by the
+    new or the previous manifest are then deleted. Must be called with the
+    lock held. Returns the new manifest.
+    '''
+    directory = os.path.dirname(MANIFEST_PATH)
+    new = dict(manifest, version=manifest['version'] + 1)
+    # Identifies this data directory, see _order_id.
+    new.setdefault('epoch', uuid.uuid4().hex)
+    for cart, data in sorted(changes.items()):
+        base = os.path.splitext(
+            os.path.basename(CART_DB_PATH if cart else STORE_DB_PATH))[0]
+        name = '{}.{}.json'.format(base, new['version'])
+        _write_json(data, os.path.join(directory, name))
+        new[_table_name(cart)] = name
+    _write_json(new, MANIFEST_PATH + '.tmp')
+    os.replace(MANIFEST_PATH + '.tmp', MANIFEST_PATH)
+    # Readers may still be using the previous version, so only clean up the
+    #   ones before it.
+    keep = {manifest['cart'], manifest['products'], new['cart'],
+            new['products']}
+    for path in (CART_DB_PATH, STORE_DB_PATH):
+        base = os.path.splitext(os.path.basename(path))[0]
+        pattern = '{}.*.json'.format(base)
+        for old in glob.glob(os.path.join(glob.escape(directory), pattern)):
+            if os.path.basename(old) not in keep:
+                os.remove(old)
+    return new
+
+
+def _read_orders():
+    '''
+    Generate every order record in the order log, oldest first.
+    '''
+    if not os.path.isfile(ORDERS_PATH):
+        return
+    with open(ORDERS_PATH, 'r') as filehandle:
+        for line in filehandle:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # The last record may be partially written if a writer died
+                #   mid-append; it will be written again on retry.
+                continue
+
+
+def _read_recent_orders(size=64 * 1024):
+    '''
+    Generate the order records in the last size bytes of the order log, oldest
+    first, without reading the rest of it.
+    '''
+    if not os.path.isfile(ORDERS_PATH):
+        return
+    with open(ORDERS_PATH, 'rb') as filehandle:
+        start = max(0, filehandle.seek(0, os.SEEK_END) - size)
+        # Start one byte early so that the first line is always partial, or
+        #   empty if start falls at the beginning of a record.
+        filehandle.seek(max(0, start - 1))
+        lines = filehandle.read().split(b'\n')
+    if start:
+        lines = lines[1:]
+    for line in lines:
+        try:
+            yield json.loads(line.decode())
+        except ValueError:
+            continue
+
+
+def _append_order(record):
+    '''
+    Append an order record to the order log. Must be called with the lock
+    held.
+    '''
+    with open(ORDERS_PATH, 'a') as filehandle:
+        filehandle.write(json.dumps(record) + '\n')
+        filehandle.flush()
+        os.fsync(filehandle.fileno())
+
+
+def _upgrade_row(row):
+    '''
+    Files written before money was stored in cents hold prices in dollars and
+    quantities in units, always serialized as json floats. Convert those to
+    their integer representations.
+    '''
+    if isinstance(row.get('Price'), float):
+        row['Price'] = _to_cents(row['Price'])
+    if isinstance(row.get('Quantity'), float):
+        row['Quantity'] = _to_quantity(row['Quantity'])
+    return row
 
 
 def _read_products():
@@ -72,6 +271,19 @@ def _read_cart():
     return _read_json(True)
 
 
+@contextlib.contextmanager
+def _locked():
+    '''
+    Context manager holding the shopping cart filesystem lock.
+    '''
+    try:
+        with ilock.ILock('grocery cart lock', timeout=5):
+            yield
+    except ilock.ILockException:
+        raise click.ClickException('Unable to acquire grocery cart lock '
+                'after 5 seconds.') from None
+
+
 def _lock(wrapped_func):
     '''
     Decorator which ensures the wrapped function with run only with the
@@ -79,29 +291,278 @@ def _lock(wrapped_func):
     '''
     @functools.wraps(wrapped_func)
     def wrapper(*args, **kwargs):
-        try:
-            with ilock.ILock('grocery cart lock', timeout=5):
-                return wrapped_func(*args, **kwargs)
-        except ilock.ILockException:
-            raise click.ClickException('Unable to acquire grocery cart lock '
-                    'after 5 seconds.') from None
+        with _locked():
+            return wrapped_func(*args, **kwargs)
     return wrapper
 
 
-def _read_json_with_lock(cart=True):
-    def _read_json_decorator(wrapped_func):
+class ConflictError(click.ClickException):
+    '''
+    Raised by Session.commit when another writer committed after the session
+    read its snapshot, or when reading a snapshot whose files are gone.
+    '''
+    def __init__(self, message='The cart or product list was changed by '
+            'another command, please try again.'):
+        super().__init__(message)
+
+
+class Session(object):
+    '''
+    An open handle on the shopping cart and product list. Each file is read
+    the first time it is used and then kept in memory, so any number of
+    operations can be run before the changes are written back with commit.
+    Used as a context manager, the session commits when the block exits
+    without an exception.
+
+    Reads see a consistent snapshot: both files are read together from the
+    version that was current when the session first read anything, and no
+    lock is taken. Reading fails with ConflictError in the unlikely case that
+    writers cleaned up that version in between. Commit writes all changes as
+    one new version, and fails with ConflictError if another writer committed
+    since the snapshot was taken.
+    '''
+    def __init__(self):
+        self._manifest = None
+        self._data = {}
+        self._dirty = set()
+        self.cart = Cart(self)
+        self.store = Store(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
+
+    def _table(self, cart=True):
+        if cart not in self._data:
+            if self._manifest is None:
+                self._manifest = _read_manifest()
+            # Read both files right away, since _commit only keeps the files
+            #   of the previous version around for readers.
+            for table in (True, False):
+                if table not in self._data:
+                    self._data[table] = _read_json(table, self._manifest)
+        return self._data[cart]
+
+    def _replace(self, data, cart=True):
+        self._data[cart] = data
+        self._dirty.add(cart)
+
+    def _changed(self, cart=True):
+        self._dirty.add(cart)
+
+    def commit(self):
         '''
-        Decorator which passes the de-serialized product list to the wrapped
-        function as keyword argument, and ensures the mutex is acquired for the
-        read.
+        Write every modified file to disk as a single new version.
         '''
-        @functools.wraps(wrapped_func)
-        @_lock
-        def wrapper(*args, **kwargs):
-            kwargs['data'] = _read_json(cart)
-            return wrapped_func(*args, **kwargs)
-        return wrapper
-    return _read_json_decorator
+        if not self._dirty:
+            return
+        with _locked():
+            manifest = _read_manifest()
+            # A session which never read anything (e.g. only emptied the
+            #   cart) doesn't depend on the previous contents.
+            if (self._manifest is not None
+                    and manifest['version'] != self._manifest['version']):
+                raise ConflictError()
+            self._manifest = _commit(manifest,
+                    {cart: self._data[cart] for cart in self._dirty})
+        self._dirty.clear()
+
+    def rollback(self):
+        '''
+        Discard all uncommitted changes. Data is re-read from the then
+        current version on next use.
+        '''
+        self._manifest = None
+        self._data.clear()
+        self._dirty.clear()
+
+
+def _transaction(operation, attempts=3):
+    '''
+    Call operation with a new Session and commit it, starting over from a
+    fresh snapshot if another writer got there first. Also used by read only
+    operations, which have nothing to commit.
+    '''
+    for attempt in range(attempts):
+        session = Session()
+        try:
+            ret = operation(session)
+            session.commit()
+            return ret
+        except ConflictError:
+            if attempt == attempts - 1:
+                raise
+
+
+def _next_id(data):
+    # The new id is one plus the previous largest id or 0 if data is empty.
+    return 0 if not data else max(data) + 1
+
+
+def _check_quantity(quantity, param_hint='quantity'):
+    '''
+    Convert a quantity in units to thousandths, making sure it is positive.
+    '''
+    quantity = _to_quantity(quantity, param_hint)
+    if quantity <= 0:
+        raise click.BadParameter('Quantity must be greater than zero.',
+          param_hint=param_hint)
+    return quantity
+
+
+class Store(object):
+    '''
+    The product list of a Session. Prices are given in dollars and products
+    are identified by integer ids.
+    '''
+    def __init__(self, session):
+        self._session = session
+
+    def items(self):
+        '''
+        Mapping of product id to stored product. Treat as read only.
+        '''
+        return self._session._table(False)
+
+    def add(self, name, units, price):
+        '''
+        Add a new product and return its id.
+        '''
+        price = _to_cents(price)
+        if price <= 0:
+            raise click.BadParameter('Price must be greater than zero.',
+              param_hint='price')
+        products = self.items()
+        product_id = _next_id(products)
+        products[product_id] = {'Name': name, 'Unit of Measure': units,
+                'Price': price}
+        self._session._changed(False)
+        return product_id
+
+    def to_cart(self, product_id, quantity):
+        '''
+        Add product with id to the cart in the given quantity and return the
+        id of the new cart item.
+        '''
+        quantity = _check_quantity(quantity)
+        if product_id not in self.items():
+            raise click.BadParameter('Error: item with id [{}] not found in '
+                    'products.'.format(product_id), param_hint='product_id')
+        return self._session.cart._add(product_id, quantity)
+
+    def remove(self, product_id):
+        '''
+        Delete a product, along with all appearances of it in the cart.
+        '''
+        products = self.items()
+        if product_id not in products:
+            raise click.BadParameter('Error: item with id [{}] not found in '
+                    'products.'.format(product_id), param_hint='product_id')
+        cart = self._session.cart.items()
+        self._session._replace({key: val for key, val in cart.items()
+                if val.get('product_id', None) != product_id})
+        products.pop(product_id)
+        self._session._changed(False)
+
+    def clear(self):
+        '''
+        Delete all products.
+        '''
+        self._session._replace({}, False)
+
+    def view(self, ascending=True, sortby=None, output_format='table',
+            **filters):
+        '''
+        Echo the product list, as done by "products view". Keyword arguments
+        are the filters accepted by the command (min_price, max_price, unit,
+        name).
+        '''
+        _view(ascending, sortby, data=self.items(), cart=False,
+                where=_where(**filters), output_format=output_format)
+
+
+class Cart(object):
+    '''
+    The shopping cart of a Session. Prices are given in dollars, quantities
+    in units, and cart items are identified by integer ids.
+    '''
+    def __init__(self, session):
+        self._session = session
+
+    def items(self):
+        '''
+        Mapping of cart item id to stored cart item. Treat as read only.
+        '''
+        return self._session._table(True)
+
+    def _add(self, product_id, quantity):
+        cart = self.items()
+        item_id = _next_id(cart)
+        cart[item_id] = {'product_id': product_id, 'Quantity': quantity}
+        self._session._changed(True)
+        return item_id
+
+    def add(self, name, units, price, quantity=1):
+        '''
+        Add a new product and put it in the cart. Returns the id of the new
+        cart item.
+        '''
+        quantity = _check_quantity(quantity)
+        return self._add(self._session.store.add(name, units, price),
+                quantity)
+
+    def update_quantity(self, item_id, new_quantity):
+        '''
+        Change the quantity of units of a cart item.
+        '''
+        new_quantity = _check_quantity(new_quantity, 'new_quantity')
+        cart = self.items()
+        if item_id not in cart:
+            raise click.BadParameter('Error: item with id [{}] not found in '
+                    'cart.'.format(item_id), param_hint='item_id')
+        cart[item_id]['Quantity'] = new_quantity
+        self._session._changed(True)
+
+    def remove(self, item_id):
+        '''
+        Delete a cart item.
+        '''
+        cart = self.items()
+        if item_id not in cart:
+            raise click.BadParameter('Error: item with id [{}] not found in '
+                    'cart.'.format(item_id), param_hint='item_id')
+        cart.pop(item_id)
+        self._session._changed(True)
+
+    def empty(self):
+        '''
+        Delete all cart items.
+        '''
+        self._session._replace({}, True)
+
+    def total(self):
+        '''
+        Grand total of the cart in cents.
+        '''
+        rows = list(_rows(self.items(),
+                read_products=self._session.store.items))
+        return _totals([row.price for row in rows],
+                [row.quantity for row in rows])[1]
+
+    def view(self, ascending=True, sortby=None, output_format='table',
+            **filters):
+        '''
+        Echo the cart, as done by "cart view". Keyword arguments are the
+        filters accepted by the command (min_price, max_price, unit, name,
+        min_subtotal).
+        '''
+        _view(ascending, sortby, data=self.items(), where=_where(**filters),
+                output_format=output_format,
+                read_products=self._session.store.items)
 
 
 @click.group()
@@ -136,14 +597,13 @@ def sleep():
 @click.argument('name', nargs=1)
 @click.argument('units', nargs=1)
 @click.argument('price', nargs=1, type=float)
-@_lock
 def add_item(name, units, price):
     '''
     Add a new item to the product list. Each item has a name (string), unit
     price ($, given as a float), and unit description (kg., liters, loafs,
     pies, boxes, cases, etc.).
     '''
-    _add_item(name, units, price, None)
+    _transaction(lambda session: session.store.add(name, units, price))
 
 
 @cart.command()
@@ -151,7 +611,6 @@ def add_item(name, units, price):
 @click.argument('units', nargs=1)
 @click.argument('price', nargs=1, type=float)
 @click.argument('quantity', default=1, type=float)
-@_lock
 def add_item(name, units, price, quantity):
     '''
     Add a new item to the shopping cart. Each item has a name (string), unit
@@ -160,117 +619,300 @@ def add_item(name, units, price, quantity):
     The number of units, as defined in the units entry, may also be given.
     Quantity defaults to 1 and accepts reals greater than zero.'
     '''
-    if quantity is not None and quantity <= 0:
-        raise click.BadParameter('Quantity must be greater than zero.',
-          param_hint='quantity')
-    product_id = _add_item(name, units, price)
-    _add_item(quantity=quantity, product_id=product_id)
+    _transaction(lambda session: session.cart.add(name, units, price,
+        quantity))
 
 
-def _add_item(name=None, units=None, price=None, quantity=None,
-        product_id=None):
-    if price is not None and price <= 0:
-        raise click.BadParameter('Price must be greater than zero.',
-          param_hint='price')
-    if quantity is not None and quantity <= 0:
-        raise click.BadParameter('Quantity must be greater than zero.',
-          param_hint='quantity')
-    products = _read_json(quantity is not None)
-    # The new id is one plus the previous largest id or 0 if products is empty.
-    item = {'product_id': product_id}
-    if product_id is None:
-        item = {'Name': name, 'Unit of Measure': units, 'Price': price}
-    if quantity is not None:
-        item['Quantity'] = quantity
-    ret = 0 if not products else max(products) + 1
-    products[ret] = item
-    _write_json(products, quantity is not None)
-    return ret
+def _filter_options(wrapped_func):
+    '''
+    Decorator which adds the row filter options shared by the view commands.
+    '''
+    options = [
+        click.option('--min-price', type=float, default=None,
+            help='Only show items with a unit price of at least this much.'),
+        click.option('--max-price', type=float, default=None,
+            help='Only show items with a unit price of at most this much.'),
+        click.option('--unit', default=None,
+            help='Only show items with exactly this unit of measure.'),
+        click.option('--name', default=None,
+            help='Only show items whose name contains this text (case '
+            'insensitive).'),
+    ]
+    for option in reversed(options):
+        wrapped_func = option(wrapped_func)
+    return wrapped_func
+
+
+def _where(min_price=None, max_price=None, unit=None, name=None,
+        min_subtotal=None):
+    '''
+    Build a predicate from the view filter options, or None if no filters
+    were given. The predicate is called with the product fields of a row
+    (name, unit, price) and its quantity, which is None for product listings,
+    and returns whether the row should be displayed.
+    '''
+    if (min_price, max_price, unit, name, min_subtotal) == (None,) * 5:
+        return None
+    if name is not None:
+        name = name.lower()
+    # Compare in cents, like the stored values.
+    if min_price is not None:
+        min_price = _to_cents(min_price, '--min-price')
+    if max_price is not None:
+        max_price = _to_cents(max_price, '--max-price')
+    if min_subtotal is not None:
+        min_subtotal = _to_cents(min_subtotal, '--min-subtotal')
+
+    def predicate(product, quantity=None):
+        price = product['Price']
+        if min_price is not None and price < min_price:
+            return False
+        if max_price is not None and price > max_price:
+            return False
+        if unit is not None and product['Unit of Measure'] != unit:
+            return False
+        if name is not None and name not in product['Name'].lower():
+            return False
+        if (min_subtotal is not None and quantity is not None
+                and _subtotals(price, quantity) < min_subtotal):
+            return False
+        return True
+    return predicate
 
 
 @store.command()
 @click.option('--ascending/--descending', default=True, help='Sort direction.')
-@click.option('--sortby', help='The column to sort by.',
-        type=click.Choice(['Name', 'Price', 'ID']), default='ID')
-def view(ascending, sortby):
+@click.option('--sortby', help='The column to sort by. Tables are sorted by '
+        'ID by default, other formats are written in storage order.',
+        type=click.Choice(['Name', 'Price', 'ID']), default=None)
+@click.option('--format', 'output_format', type=click.Choice(FORMATS),
+        default='table', help='Output format.')
+@_filter_options
+def view(ascending, sortby, output_format, **filters):
     '''
     Display current product listings. Contents are displayed with
     subtotals and can be sorted multiple ways.
     '''
-    _read_json_with_lock(False)(_view)(ascending, sortby, cart=False)
+    _transaction(lambda session: session.store.view(ascending, sortby,
+        output_format, **filters))
 
 
 @cart.command()
 @click.option('--ascending/--descending', default=True, help='Sort direction.')
-@click.option('--sortby', help='The column to sort by.',
-        type=click.Choice(['Name', 'Subtotal', 'Price', 'ID']), default='ID')
-def view(ascending, sortby):
+@click.option('--sortby', help='The column to sort by. Tables are sorted by '
+        'ID by default, other formats are written in storage order.',
+        type=click.Choice(['Name', 'Subtotal', 'Price', 'ID']), default=None)
+@click.option('--format', 'output_format', type=click.Choice(FORMATS),
+        default='table', help='Output format.')
+@_filter_options
+@click.option('--min-subtotal', type=float, default=None,
+        help='Only show items with a subtotal of at least this much.')
+def view(ascending, sortby, output_format, **filters):
     '''
     Display current shopping cart contents. Contents are displayed with
     subtotals and can be sorted multiple ways.
     '''
-    _read_json_with_lock()(_view)(ascending, sortby)
+    _transaction(lambda session: session.cart.view(ascending, sortby,
+        output_format, **filters))
+
+
+class _Row(object):
+    '''
+    Compact record of a single row displayed by view, holding the raw values
+    of each column until the row is rendered.
+    '''
+    __slots__ = ('id', 'name', 'units', 'quantity', 'price', 'subtotal')
+
+    def __init__(self, id, name, units, price, quantity=None, subtotal=None):
+        self.id = id
+        self.name = name
+        self.units = units
+        self.price = price
+        self.quantity = quantity
+        self.subtotal = subtotal
+
+    def cells(self, cart=True):
+        '''
+        Format the row as a tuple of strings in HEADER column order.
+        '''
+        if not cart:
+            return (self.id, self.name, self.units, _format_price(self.price))
+        return (self.id, self.name, self.units,
+                _format_quantity(self.quantity),
+                _format_price(self.price), _format_price(self.subtotal))
+
+    def values(self, cart=True):
+        '''
+        The raw values of the row in FIELDS order, for machine readable output.
+        '''
+        if not cart:
+            return (int(self.id), self.name, self.units, self.price)
+        return (int(self.id), self.name, self.units,
+                self.quantity / QUANTITY_SCALE, self.price, self.subtotal)
+
+
+# Attribute of _Row holding the value for each sortable column.
+_SORT_KEYS = {
+    'ID': operator.attrgetter('id'),
+    'Name': operator.attrgetter('name'),
+    'Price': operator.attrgetter('price'),
+    'Subtotal': operator.attrgetter('subtotal'),
+}
+
+
+def _numeric_id(row):
+    return int(row.id)
+
+
+def _rows(data, cart=True, where=None, subtotals=False, read_products=None):
+    '''
+    Generate a _Row for each item in data matching where, joining cart items
+    with their product listing, which is fetched by calling read_products
+    (reading it from disk by default) the first time it is needed. If
+    subtotals is set, each cart row's subtotal is computed as it is generated.
+    '''
+    if read_products is None:
+        read_products = _read_products
+    products = None
+    for idx, row in data.items():
+        product = row
+        if 'product_id' in row:
+            if products is None:
+                products = read_products()
+            product = products[row['product_id']]
+        quantity = row.get('Quantity')
+        # Filter before building or formatting the row so that rows which
+        #   don't match cost as little as possible.
+        if where is not None and not where(product, quantity):
+            continue
+        row = _Row(str(idx), product['Name'], product['Unit of Measure'],
+            product['Price'], quantity)
+        if cart and subtotals:
+            row.subtotal = _subtotals(row.price, row.quantity)
+        yield row
+
+
+class _EchoStream(object):
+    '''
+    Minimal file-like object writing through click.echo, for csv.writer.
+    '''
+    def write(self, text):
+        click.echo(text, nl=False)
+
+
+def _stream(ascending, sortby, data=None, cart=True, where=None,
+        output_format='json', read_products=None):
+    '''
+    Write rows in a machine readable format one at a time as they are read.
+    Values are written raw, with money in integer cents, and no rows are held
+    in memory unless they have to be sorted.
+    '''
+    fields = FIELDS.split(',')
+    if not cart:
+        fields.remove('quantity')
+        fields.remove('subtotal_cents')
+    rows = _rows(data or {}, cart, where, subtotals=True,
+            read_products=read_products)
+    if sortby is not None:
+        key = _SORT_KEYS[sortby]
+        if sortby == 'ID':
+            # Ids are written as integers here, so sort them as numbers.
+            #   Tables keep sorting them as text, as they always have.
+            key = _numeric_id
+        rows = sorted(rows, key=key, reverse=not ascending)
+    elif not ascending:
+        rows = reversed(list(rows))
+    if output_format == 'csv':
+        writer = csv.writer(_EchoStream(), lineterminator='\n')
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(row.values(cart))
+    elif output_format == 'ndjson':
+        for row in rows:
+            click.echo(json.dumps(dict(zip(fields, row.values(cart)))))
+    else:
+        separator = '['
+        for row in rows:
+            click.echo(separator, nl=False)
+            click.echo(json.dumps(dict(zip(fields, row.values(cart)))),
+                nl=False)
+            separator = ','
+        click.echo('[]' if separator == '[' else ']')
 
 
-def _view(ascending, sortby, data=None, cart=True):
+def _view(ascending, sortby, data=None, cart=True, where=None,
+        output_format='table', read_products=None):
+    if output_format != 'table':
+        _stream(ascending, sortby, data, cart, where, output_format,
+                read_products)
+        return
     if not data:
         click.echo('Empty.')
         return
+    if sortby is None:
+        sortby = 'ID'
     header = HEADER.split(',')
-    products = None
     if cart:
         # Create new column for subtotal.
         header.append('Subtotal')
-        # Keep total of subtotals to display grand total at end.
-        total = 0
     else:
         header.remove('Quantity')
-    rows = []
-    for idx, row in data.items():
-        if 'product_id' in row:
-            if products is None:
-                products = _read_products()
-            row.update(products[row['product_id']])
-            row.pop('product_id')
-        if cart:
-            # calculate subtotal and update grand total.
-            row['Subtotal'] = row['Price'] * row['Quantity']
-            total += row['Subtotal']
-        row['ID'] = str(idx)
-        rows.append(row)
-    # Sort values before string formatting.
-    rows = sorted(rows, key=lambda x: x[sortby], reverse=not ascending)
-    # Keep track of widest item in column to help with text formatting.
-    col_width = {label: len(label) for label in header}
-    for row in rows:
-        # format other columns as strings
-        row['Price'] = _format_price(row['Price'])
-        if cart:
-            row['Subtotal'] = _format_price(row['Subtotal'])
-            row['Quantity'] = '{}'.format(row['Quantity'])
-        # Update maximum column widths if any of the strings are longer than
-        #    previous values.
-        col_width = {label: max(col_width[label], len(row[label]))
-            for label in header}
+    rows = list(_rows(data, cart, where, read_products=read_products))
+    if not rows:
+        click.echo('No matching items.')
+        return
     if cart:
-        total = _format_price(total)
-        # Ensure that the grand total will fit in the subtotal columns.
-        col_width['Subtotal'] = max(col_width['Subtotal'], len(total))
+        # calculate all subtotals and the grand total at once.
+        subtotals, total = _totals([row.price for row in rows],
+            [row.quantity for row in rows])
+        for row, subtotal in zip(rows, subtotals.tolist()):
+            row.subtotal = subtotal
+    # Sort values before string formatting.
+    rows.sort(key=_SORT_KEYS[sortby], reverse=not ascending)
+    cells = [row.cells(cart) for row in rows]
+    col_width = _column_widths(header, cells)
+    if not cart:
+        _echo_table(header, cells, col_width)
+        return
+    total = _format_price(total)
+    # Ensure that the grand total will fit in the subtotal columns.
+    col_width[-1] = max(col_width[-1], len(total))
+    _echo_table(header, cells, col_width, ['', 'Total', '', '', '', total])
+
+
+def _column_widths(header, cells):
+    '''
+    Width of the widest item in each column, to help with text formatting.
+    '''
+    col_width = [len(label) for label in header]
+    for values in cells:
+        for col, value in enumerate(values):
+            if len(value) > col_width[col]:
+                col_width[col] = len(value)
+    return col_width
+
+
+def _echo_table(header, cells, col_width, footer=None):
+    '''
+    Echo rows of strings as a text table under header, padding each column
+    to col_width, with an optional footer row (e.g. a grand total) separated
+    from the rest by a line.
+    '''
     # Create format string for each column which can be used to pad values in
     # that column.
-    col_width = {label: ' {{: <{}}}'.format(width) for label, width in
-        col_width.items()}
-    # Format each row of the cart.
+    col_width = [' {{: <{}}}'.format(width) for width in col_width]
+    # Format each row.
     lines = [
-      ' |'.join([col_width[col].format(row[col]) for col in header])
-      for row in rows
+      ' |'.join([fmt.format(value) for fmt, value in zip(col_width, row)])
+      for row in cells
     ]
-    # add header and total lines and some horizontal lines.
-    if cart:
+    # add header and footer lines and some horizontal lines.
+    if footer is not None:
         lines.append('-' * max(len(line) for line in lines))
-        lines.append('  '.join(col_width[col].format(val) for col, val in
-            zip(header, ['', 'Total', '', '', '', total])))
-    lines.insert(0, ' |'.join(col_width[col].format(col) for col in header))
+        lines.append('  '.join(fmt.format(val) for fmt, val in
+            zip(col_width, footer)))
+    lines.insert(0, ' |'.join(fmt.format(col) for fmt, col in
+        zip(col_width, header)))
     lines.insert(1, '-' * max(len(line) for line in lines))
     # combine rows and print.
     lines = '\n'.join(lines)
@@ -280,53 +922,29 @@ def _view(ascending, sortby, data=None, cart=True):
 @store.command()
 @click.argument('product_id', nargs=1, type=int)
 @click.argument('quantity', nargs=1, type=float)
-@_lock
 def to_cart(product_id, quantity):
     '''
     Add product with id to cart in given quantity.
     '''
-    cart = _read_cart()
-    products = _read_products()
-    if product_id not in products:
-        raise click.BadParameter('Error: item with id [{}] not found in '
-                'products.'.format(product_id), param_hint='product_id')
-    item = products[product_id]
-    _add_item(quantity=quantity, product_id=product_id)
+    _transaction(lambda session: session.store.to_cart(product_id, quantity))
 
 
 @store.command()
 @click.argument('product_id', nargs=1, type=int)
-@_lock
 def remove(product_id):
     '''
     Delete products list item by ID.
     '''
-    # First remove all appearances of the product in the cart
-    cart = _read_cart()
-    cart = {key: val for key, val in cart.items()
-            if val.get('product_id', None) != product_id}
-    _write_json(cart)
-    # Now remove the product from the listing
-    _remove(product_id, False)
+    _transaction(lambda session: session.store.remove(product_id))
 
 
 @cart.command()
 @click.argument('item_id', nargs=1, type=int)
-@_lock
 def remove(item_id):
     '''
     Delete shopping cart item by ID.
     '''
-    _remove(item_id)
-
-def _remove(item_id, cart=True):
-    data = _read_json(cart)
-    if item_id not in data:
-        raise click.BadParameter('Error: item with id [{}] not found in '
-                '{}.'.format(item_id, 'cart' if cart else 'products'),
-                param_hint='item_id' if cart else 'product_id')
-    data.pop(item_id)
-    _write_json(data, cart)
+    _transaction(lambda session: session.cart.remove(item_id))
 
 
 def billing_prompt(query, pattern):
@@ -341,17 +959,141 @@ def _card_auth(card, code, date, zipcode):
     pass
 
 
+class PaymentError(click.ClickException):
+    '''
+    Raised by a PaymentAdapter when a payment is declined.
+    '''
+    pass
+
+
+class PaymentAdapter(abc.ABC):
+    '''
+    Interface to a payment provider used by checkout. Methods are coroutines
+    so that providers can talk to remote services without blocking. Set
+    PAYMENT_ADAPTER to an instance of a subclass to use it.
+    '''
+    @abc.abstractmethod
+    async def authorize(self, order_id, idempotency_key, amount, method,
+            details):
+        '''
+        Authorize a payment of amount cents for order_id using method ('card'
+        or 'paypal') with the billing details collected for it, and return a
+        reference to the authorization. Raises PaymentError if declined.
+        order_id is the same every time a cart is checked out, while
+        idempotency_key is new for each checkout, also when an earlier one of
+        the same cart was abandoned and voided.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def void(self, authorization):
+        '''
+        Cancel an authorization for an order which was not placed.
+        '''
+        raise NotImplementedError
+
+
+class LocalPaymentAdapter(PaymentAdapter):
+    '''
+    Stub adapter which approves every payment without contacting anyone.
+    '''
+    async def authorize(self, order_id, idempotency_key, amount, method,
+            details):
+        if method == 'card':
+            _card_auth(details['number'], details['security_code'],
+                    details['expire_date'], details['zip_code'])
+        return 'local-{}'.format(idempotency_key)
+
+    async def void(self, authorization):
+        pass
+
+
+PAYMENT_ADAPTER = LocalPaymentAdapter()
+
+
+def _run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _order_id(manifest):
+    '''
+    Identify the order for the cart of a snapshot. Cart files are never
+    reused within a data directory, so checking out the same snapshot more
+    than once always gives the same id.
+    '''
+    key = '{}/{}'.format(manifest.get('epoch', ''), manifest['cart'])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _find_order(order_id):
+    '''
+    Return the record of a recently placed order, or None if there is none.
+    '''
+    for order in _read_recent_orders():
+        if order['order_id'] == order_id:
+            return order
+    return None
+
+
+def _place_order(snapshot, record):
+    '''
+    Record an order and empty the cart, provided the cart is still the one
+    in snapshot. Returns True if record was appended to the order log, and
+    False if the order was already placed, in which case only the cart is
+    emptied if it hasn't been yet. Raises ConflictError if the cart has
+    changed since and the order wasn't placed. Safe to retry: the order is
+    only recorded once.
+    '''
+    with _locked():
+        manifest = _read_manifest()
+        # The order can only have been recorded by a checkout of the same
+        #   snapshot, which must have happened recently since it didn't get
+        #   as far as emptying the cart. Checking the end of the log keeps the
+        #   time spent holding the lock constant.
+        placed = _find_order(record['order_id']) is not None
+        if manifest['cart'] != snapshot['cart']:
+            if placed:
+                return False
+            raise ConflictError()
+        if not placed:
+            _append_order(record)
+        _commit(manifest, {True: {}})
+    return not placed
+
+
 @cart.command()
 @click.argument('method', nargs=1, type=click.Choice(['card', 'paypal']))
-@_read_json_with_lock()
-def checkout(data, method):
+def checkout(method):
     '''
     Enter billing information and confirm items. Argument is a choice of
     payment method.
     '''
+    # Take a snapshot of the cart. No lock is held until the order is placed,
+    #   so other commands can run while billing details are entered.
+    session, data = _transaction(lambda session: (session,
+        session.cart.items()))
     if not data:
         click.echo('Please add items to cart before checking out.')
         return
+    rows = list(_rows(data, subtotals=True,
+            read_products=session.store.items))
+    total = _totals([row.price for row in rows],
+            [row.quantity for row in rows])[1]
+    order_id = _order_id(session._manifest)
+    placed = _find_order(order_id)
+    if placed is not None:
+        # A previous checkout recorded the order but failed before emptying
+        #   the cart, so just finish that.
+        _place_order(session._manifest, placed)
+        click.echo('This order has already been placed.')
+        click.echo('Cart cleared.')
+        return
+    # Collect billing details.
+    shipping_address = None
     if method == 'card':
         number = billing_prompt('Please enter credit card number (no dashes)',
                 r'^\d{16}$')
@@ -363,10 +1105,9 @@ def checkout(data, method):
             raise click.UsageError('Month must be in [1-12]')
         zip_code = billing_prompt('Please enter billing zip code', r'^\d{5}$')
         shipping_address = click.prompt('Please enter shipping address')
+        details = {'number': number, 'security_code': security_code,
+                'expire_date': expire_date, 'zip_code': zip_code}
         click.echo('stealing your money (kidding...)')
-        _card_auth(number, security_code, expire_date, zip_code)
-        click.echo('card number: ************{}'.format(number[-4:]))
-        click.echo('shipping address: {}'.format(shipping_address))
     if method == 'paypal':
         email = billing_prompt('Please enter paypal account email',
                 r'^.+@[^.].+\..+[^.]$')
@@ -374,35 +1115,84 @@ def checkout(data, method):
         click.echo('Authenticating with paypal using [{}]...'.format(email))
         if not click.confirm('Use paypal shipping address?'):
             shipping_address = click.prompt('Please enter shipping address')
-    _read_json_with_lock()(_view)(True, 'ID')
-    if click.confirm('Confirm order and payment details?'):
-        # charge money, begin transaction, etc, then empty the cart.
-        _empty()
-        click.echo('Thank you for your purchase!')
+        details = {'email': email}
+    # Authorize the payment.
+    authorization = _run_async(PAYMENT_ADAPTER.authorize(order_id,
+            uuid.uuid4().hex, total, method, details))
+    if method == 'card':
+        click.echo('card number: ************{}'.format(number[-4:]))
+        click.echo('shipping address: {}'.format(shipping_address))
+    _view(True, 'ID', data=data, read_products=session.store.items)
+    if not click.confirm('Confirm order and payment details?'):
+        _run_async(PAYMENT_ADAPTER.void(authorization))
+        return
+    # Place the order and empty the cart, unless it changed in the meantime.
+    fields = FIELDS.split(',')
+    record = {'order_id': order_id, 'time': time.time(), 'method': method,
+            'authorization': authorization,
+            'shipping_address': shipping_address, 'total_cents': total,
+            'items': [dict(zip(fields, row.values())) for row in rows]}
+    try:
+        placed = _place_order(session._manifest, record)
+    except BaseException:
+        # Keep the authorization only if the order was recorded with it before
+        #   the failure; checking out again then just empties the cart.
+        recorded = _find_order(order_id)
+        if recorded is None or recorded['authorization'] != authorization:
+            _run_async(PAYMENT_ADAPTER.void(authorization))
+        raise
+    if not placed:
+        # A concurrent checkout of the same cart got there first.
+        _run_async(PAYMENT_ADAPTER.void(authorization))
+        click.echo('This order has already been placed.')
+        return
+    click.echo('Cart cleared.')
+    click.echo('Thank you for your purchase!')
+
+
+@cart.command()
+@click.option('--format', 'output_format',
+        type=click.Choice(['table', 'json', 'ndjson']), default='table',
+        help='Output format.')
+def orders(output_format):
+    '''
+    Display the history of placed orders, oldest first.
+    '''
+    if output_format == 'ndjson':
+        for record in _read_orders():
+            click.echo(json.dumps(record))
+        return
+    if output_format == 'json':
+        separator = '['
+        for record in _read_orders():
+            click.echo(separator, nl=False)
+            click.echo(json.dumps(record), nl=False)
+            separator = ','
+        click.echo('[]' if separator == '[' else ']')
+        return
+    cells = [(record['order_id'],
+              time.strftime('%Y-%m-%d %H:%M', time.localtime(record['time'])),
+              record['method'], str(len(record['items'])),
+              _format_price(record['total_cents']))
+             for record in _read_orders()]
+    if not cells:
+        click.echo('No orders.')
+        return
+    header = ORDER_HEADER.split(',')
+    _echo_table(header, cells, _column_widths(header, cells))
 
 
 @cart.command()
 @click.argument('item_id', nargs=1, type=int)
 @click.argument('new_quantity', nargs=1, type=float)
-@_lock
 def update_quantity(item_id, new_quantity):
     '''
     Update the quantity of units for an item in the shopping cart.
     The item is identified by its id and the new quantity is a real greater
     than zero.
     '''
-    if new_quantity <= 0:
-        raise click.BadParameter('Quantity must be greater than zero.',
-          param_hint='new_quantity')
-    # load the preexisting cart data.
-    cart = _read_json()
-    if item_id not in cart:
-        raise click.BadParameter('Error: item with id [{}] not found in '
-                'cart.'.format(item_id), param_hint='item_id')
-    # Update the quantity of the given item
-    cart[item_id]['Quantity'] = new_quantity
-    # Write the update back to disk.
-    _write_json(cart)
+    _transaction(lambda session: session.cart.update_quantity(item_id,
+        new_quantity))
 
 
 @cart.command()
@@ -410,7 +1200,8 @@ def empty():
     '''
     Delete all items in the shopping cart.
     '''
-    _empty()
+    _transaction(lambda session: session.cart.empty())
+    click.echo('Cart cleared.')
 
 
 @store.command()
@@ -418,11 +1209,5 @@ def clear():
     '''
     Delete all items in the products list.
     '''
-    _empty(False)
-
-
-@_lock
-def _empty(cart=True):
-    # simply write an empty cart to disk.
-    _write_json({}, cart)
-    click.echo('{} cleared.'.format('Cart' if cart else 'Products list'))
+    _transaction(lambda session: session.store.clear())
+    click.echo('Products list cleared.')
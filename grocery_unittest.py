@@ -1,3 +1,7 @@
+import json
+import os
+import tempfile
+import time
 import unittest.mock
 
 import click.testing
@@ -5,6 +9,13 @@ import click.testing
 import grocery as module_ut
 
 _ = unittest.mock.sentinel
+MANIFEST = {'version': 3, 'cart': 'cart.json', 'products': 'products.json'}
+CART = {
+    1: {'Name': 'pizza', 'Unit of Measure': 'pies', 'Price': 600,
+        'Quantity': 2000},
+    2: {'Name': 'wine', 'Unit of Measure': 'bottles', 'Price': 999,
+        'Quantity': 1000},
+}
 
 
 def mymock(return_value, spec=None):
@@ -16,15 +27,17 @@ def mymock(return_value, spec=None):
 class TestModule(unittest.TestCase):
     def test_empty(self):
         runner = click.testing.CliRunner()
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         mock_lock = unittest.mock.MagicMock()
-        with unittest.mock.patch('grocery._write_json', mock_write_json
+        with unittest.mock.patch('grocery._commit', mock_commit
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
                 ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                 ):
             result = runner.invoke(module_ut.cart, ['empty'])
         self.assertEqual(0, result.exit_code)
         self.assertEqual('Cart cleared.\n', result.output)
-        mock_write_json.assert_called_once_with({}, True)
+        mock_commit.assert_called_once_with(MANIFEST, {True: {}})
         mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
 
     def test_view_empty(self):
@@ -32,20 +45,27 @@ class TestModule(unittest.TestCase):
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({})
         with unittest.mock.patch('grocery._read_json', mock_read_json
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
                 ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                 ):
             result = runner.invoke(module_ut.cart, ['view'])
         self.assertEqual(0, result.exit_code)
         self.assertEqual('Empty.\n', result.output)
-        mock_read_json.assert_called_once_with(True)
-        mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
+        # Both files of the snapshot are read together.
+        self.assertEqual([unittest.mock.call(True, MANIFEST),
+            unittest.mock.call(False, MANIFEST)],
+            mock_read_json.call_args_list)
+        self.assertFalse(mock_lock.called)
 
     def test_view(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({2: {'Name': 'Wine',
-            'Unit of Measure': 'Bottles', 'Quantity': 2, 'Price': 9.99}})
+            'Unit of Measure': 'Bottles', 'Quantity': 2000, 'Price': 999}})
         with unittest.mock.patch('grocery._read_json', mock_read_json
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
                 ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                 ):
             result = runner.invoke(module_ut.cart, ['view'])
@@ -58,44 +78,222 @@ class TestModule(unittest.TestCase):
             result.output
         )
         self.assertEqual(0, result.exit_code)
-        mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
+        self.assertFalse(mock_lock.called)
+
+    def test_view_filter(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.MagicMock()
+        mock_read_json = mymock({
+            2: {'Name': 'Wine', 'Unit of Measure': 'Bottles',
+                'Quantity': 2000, 'Price': 999},
+            3: {'Name': 'Bread', 'Unit of Measure': 'Loafs',
+                'Quantity': 1000, 'Price': 325},
+            4: {'Name': 'White wine', 'Unit of Measure': 'Bottles',
+                'Quantity': 1000, 'Price': 1250},
+        })
+        with unittest.mock.patch('grocery._read_json', mock_read_json
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
+                ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+                ):
+            result = runner.invoke(module_ut.cart, ['view', '--name', 'wine',
+                '--unit', 'Bottles', '--max-price', '10', '--min-subtotal',
+                '15'])
+        self.assertEqual(
+            ' ID | Name | Unit of Measure | Quantity | Price | Subtotal\n'
+            '-----------------------------------------------------------\n'
+            ' 2  | Wine | Bottles         | 2        | $9.99 | $19.98  \n'
+            '----------------------------------------------------------\n'
+            '      Total                                        $19.98  \n',
+            result.output
+        )
+        self.assertEqual(0, result.exit_code)
+
+    def test_view_filter_no_match(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.MagicMock()
+        mock_read_json = mymock({2: {'Name': 'Wine',
+            'Unit of Measure': 'Bottles', 'Price': 999}})
+        with unittest.mock.patch('grocery._read_json', mock_read_json
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
+                ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+                ):
+            result = runner.invoke(module_ut.store, ['view', '--min-price',
+                '10'])
+        self.assertEqual('No matching items.\n', result.output)
+        self.assertEqual(0, result.exit_code)
+        # Both files of the snapshot are read together.
+        self.assertEqual([unittest.mock.call(True, MANIFEST),
+            unittest.mock.call(False, MANIFEST)],
+            mock_read_json.call_args_list)
+
+    def test_view_rounding(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.MagicMock()
+        mock_read_json = mymock({
+            1: {'Name': 'kombucha', 'Unit of Measure': 'lb',
+                'Quantity': 4192, 'Price': 335},
+            2: {'Name': 'kombucha', 'Unit of Measure': 'lb',
+                'Quantity': 1500, 'Price': 1},
+        })
+        with unittest.mock.patch('grocery._read_json', mock_read_json
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
+                ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+                ):
+            result = runner.invoke(module_ut.cart, ['view'])
+        self.assertEqual(
+            ' ID | Name     | Unit of Measure | Quantity | Price | Subtotal\n'
+            '--------------------------------------------------------------\n'
+            ' 1  | kombucha | lb              | 4.192    | $3.35 | $14.04  \n'
+            ' 2  | kombucha | lb              | 1.5      | $0.01 | $0.02   \n'
+            '--------------------------------------------------------------\n'
+            '      Total                                           $14.06  \n',
+            result.output
+        )
+        self.assertEqual(0, result.exit_code)
+
+    def test_view_formats(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.MagicMock()
+        mock_read_json = unittest.mock.Mock(spec=[],
+          side_effect=lambda cart, manifest: {
+            2: {'Name': 'Wine', 'Unit of Measure': 'Bottles',
+                'Quantity': 2000, 'Price': 999},
+            3: {'Name': 'Bread, sliced', 'Unit of Measure': 'Loafs',
+                'Quantity': 1500, 'Price': 325},
+        })
+        with unittest.mock.patch('grocery._read_json', mock_read_json
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
+                ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+                ):
+            json_result = runner.invoke(module_ut.cart,
+                ['view', '--format', 'json'])
+            csv_result = runner.invoke(module_ut.cart,
+                ['view', '--format', 'csv', '--sortby', 'Price'])
+            ndjson_result = runner.invoke(module_ut.store,
+                ['view', '--format', 'ndjson', '--descending'])
+        self.assertEqual(
+            '[{"id": 2, "name": "Wine", "units": "Bottles", "quantity": 2.0, '
+            '"price_cents": 999, "subtotal_cents": 1998},'
+            '{"id": 3, "name": "Bread, sliced", "units": "Loafs", '
+            '"quantity": 1.5, "price_cents": 325, "subtotal_cents": 488}]\n',
+            json_result.output
+        )
+        self.assertEqual(
+            'id,name,units,quantity,price_cents,subtotal_cents\n'
+            '3,"Bread, sliced",Loafs,1.5,325,488\n'
+            '2,Wine,Bottles,2.0,999,1998\n',
+            csv_result.output
+        )
+        self.assertEqual(
+            '{"id": 3, "name": "Bread, sliced", "units": "Loafs", '
+            '"price_cents": 325}\n'
+            '{"id": 2, "name": "Wine", "units": "Bottles", '
+            '"price_cents": 999}\n',
+            ndjson_result.output
+        )
+
+    def test_view_formats_sort_id(self):
+        runner = click.testing.CliRunner()
+        products = {
+            10: {'Name': 'Wine', 'Unit of Measure': 'Bottles', 'Price': 999},
+            2: {'Name': 'Bread', 'Unit of Measure': 'Loafs', 'Price': 325},
+        }
+        with unittest.mock.patch('grocery._read_json',
+                    unittest.mock.Mock(spec=[],
+                        side_effect=lambda cart, manifest: dict(products))
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
+                ):
+            result = runner.invoke(module_ut.store,
+                ['view', '--format', 'csv', '--sortby', 'ID'])
+        self.assertEqual(
+            'id,name,units,price_cents\n'
+            '2,Bread,Loafs,325\n'
+            '10,Wine,Bottles,999\n',
+            result.output
+        )
+
+    def test_view_json_empty(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.MagicMock()
+        mock_read_json = mymock({})
+        with unittest.mock.patch('grocery._read_json', mock_read_json
+                ), unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)
+                ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+                ):
+            result = runner.invoke(module_ut.cart,
+                ['view', '--format', 'json'])
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual('[]\n', result.output)
+
+    def test_totals_overflow(self):
+        # A subtotal of $100 trillion and a total past the 64 bit range.
+        prices, quantities = [10 ** 10, 10 ** 10], [10 ** 9, 10 ** 9]
+        subtotals, total = module_ut._totals(prices, quantities)
+        self.assertEqual([10 ** 16, 10 ** 16], subtotals.tolist())
+        self.assertEqual(2 * 10 ** 16, total)
+        self.assertEqual([module_ut._subtotals(price, quantity)
+            for price, quantity in zip(prices, quantities)],
+            subtotals.tolist())
+        subtotals, total = module_ut._totals([2 ** 62] * 3, [1000] * 3)
+        self.assertEqual(3 * 2 ** 62, total)
+
+    def test_totals(self):
+        subtotals, total = module_ut._totals([335, 1, 999], [4192, 1500, 3000])
+        self.assertEqual([1404, 2, 2997], subtotals.tolist())
+        self.assertEqual(4403, total)
+
+    def test_upgrade_row(self):
+        self.assertEqual({'Price': 999, 'Quantity': 4192},
+            module_ut._upgrade_row({'Price': 9.99, 'Quantity': 4.192}))
+        self.assertEqual({'product_id': 3, 'Quantity': 2000},
+            module_ut._upgrade_row({'product_id': 3, 'Quantity': 2000}))
 
     def test_remove(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
-              ), unittest.mock.patch('grocery._write_json', mock_write_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
+              ), unittest.mock.patch('grocery._commit', mock_commit
               ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
               ):
             result = runner.invoke(module_ut.cart, ['remove', '1'])
         self.assertEqual(0, result.exit_code)
         self.assertEqual('', result.output)
-        mock_write_json.assert_called_once_with({2: _.row_b}, True)
+        mock_commit.assert_called_once_with(MANIFEST, {True: {2: _.row_b}})
         mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
 
     def test_update_quantity(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         cart = {1: _.row_a, 2: _.row_b,
-            3: {'Name': 'pizza', 'Price': 6.0, 'Unit of Measure': 'pies',
-                'Quantity': 1.0}
+            3: {'Name': 'pizza', 'Price': 600, 'Unit of Measure': 'pies',
+                'Quantity': 1000}
         }
         mock_read_json = mymock(cart)
         ret = cart.copy()
         ret[3] = ret[3].copy()
-        ret[3]['Quantity'] = 2.0
-        mock_write_json = mymock(None)
+        ret[3]['Quantity'] = 2000
+        mock_commit = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
-              ), unittest.mock.patch('grocery._write_json', mock_write_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
+              ), unittest.mock.patch('grocery._commit', mock_commit
               ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
               ):
             result = runner.invoke(module_ut.cart,
                       ['update_quantity', '3', '2'])
         self.assertEqual(0, result.exit_code)
         self.assertEqual('', result.output)
-        mock_write_json.assert_called_once_with(ret)
+        mock_commit.assert_called_once_with(MANIFEST, {True: ret})
         mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
 
     def test_add_item(self):
@@ -103,11 +301,14 @@ class TestModule(unittest.TestCase):
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({2: _.row_a})
         mock_read_json = unittest.mock.Mock(spec=[],
-          side_effect=lambda cart: ({2: _.row_a} if cart else {3: _.row_b})
+          side_effect=lambda cart, manifest: (
+              {2: _.row_a} if cart else {3: _.row_b})
         )
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
-              ), unittest.mock.patch('grocery._write_json', mock_write_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
+              ), unittest.mock.patch('grocery._commit', mock_commit
               ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
               ):
             result = runner.invoke(module_ut.cart,
@@ -115,75 +316,114 @@ class TestModule(unittest.TestCase):
             )
         self.assertEqual(0, result.exit_code)
         self.assertEqual('', result.output)
-        self.assertEqual(len(mock_write_json.call_args_list), 2)
-        self.assertEqual(mock_write_json.call_args_list[0],
-                unittest.mock.call({3: _.row_b, 4: {'Price': 6.0,
-                    'Name': 'pizza', 'Unit of Measure': 'pies'}}, False))
-        self.assertEqual(mock_write_json.call_args_list[1],
-                unittest.mock.call({2: _.row_a, 3: {'Quantity': 1.0,
-                    'product_id': 4}}, True
-                    ))
+        mock_commit.assert_called_once_with(MANIFEST, {
+                False: {3: _.row_b, 4: {'Price': 600, 'Name': 'pizza',
+                    'Unit of Measure': 'pies'}},
+                True: {2: _.row_a, 3: {'Quantity': 1000, 'product_id': 4}},
+        })
         self.assertTrue(mock_lock.called)
 
     def test_add_item_bad_price(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
               ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
-              ), unittest.mock.patch('grocery._write_json', mock_write_json
+              ), unittest.mock.patch('grocery._commit', mock_commit
               ):
             result = runner.invoke(module_ut.cart,
                     ['add_item', 'name', 'unit', '--', '-1.2'])
         self.assertEqual(2, result.exit_code)
-        self.assertFalse(mock_write_json.called)
-        mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
+        self.assertFalse(mock_commit.called)
+        self.assertFalse(mock_lock.called)
+
+    def test_non_finite_values(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.MagicMock()
+        mock_commit = mymock(None)
+        with unittest.mock.patch('grocery._read_json',
+                  unittest.mock.Mock(spec=[],
+                      side_effect=lambda cart, manifest: dict(CART))
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
+              ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+              ), unittest.mock.patch('grocery._commit', mock_commit
+              ):
+            for group, args, hint in [
+                    (module_ut.store, ['add_item', 'x', 'y', 'inf'], 'price'),
+                    (module_ut.cart, ['add_item', 'x', 'y', 'nan'], 'price'),
+                    (module_ut.cart, ['add_item', 'x', 'y', '1', 'inf'],
+                        'quantity'),
+                    (module_ut.store, ['to_cart', '1', 'nan'], 'quantity'),
+                    (module_ut.cart, ['update_quantity', '1', 'inf'],
+                        'new_quantity'),
+                    (module_ut.cart, ['view', '--min-price', 'nan'],
+                        '--min-price'),
+                    (module_ut.store, ['view', '--max-price', 'inf'],
+                        '--max-price'),
+                    (module_ut.cart, ['view', '--min-subtotal', '-inf'],
+                        '--min-subtotal'),
+                    ]:
+                result = runner.invoke(group, args)
+                self.assertEqual(2, result.exit_code, args)
+                self.assertIn('Invalid value for {}: Must be a finite'.format(hint),
+                    result.output)
+        self.assertFalse(mock_commit.called)
+        self.assertFalse(mock_lock.called)
 
     def test_add_item_bad_quanity(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
               ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
-              ), unittest.mock.patch('grocery._write_json', mock_write_json
+              ), unittest.mock.patch('grocery._commit', mock_commit
               ):
             result = runner.invoke(module_ut.cart,
                     ['add_item', 'name', 'unit', '2', '--', '-1'])
         self.assertEqual(2, result.exit_code)
-        self.assertFalse(mock_write_json.called)
-        mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
+        self.assertFalse(mock_commit.called)
+        self.assertFalse(mock_lock.called)
 
     def test_update_bad_quantity(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
               ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
-              ), unittest.mock.patch('grocery._write_json', mock_write_json
+              ), unittest.mock.patch('grocery._commit', mock_commit
               ):
             result = runner.invoke(module_ut.cart,
                     ['update_quantity', '2', '--', '-1'])
         self.assertEqual(2, result.exit_code)
-        self.assertFalse(mock_write_json.called)
-        mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
+        self.assertFalse(mock_commit.called)
+        self.assertFalse(mock_lock.called)
 
     def test_update_bad_id(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
               ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
-              ), unittest.mock.patch('grocery._write_json', mock_write_json
+              ), unittest.mock.patch('grocery._commit', mock_commit
               ):
             result = runner.invoke(module_ut.cart,
                     ['update_quantity', '3', '1.2'])
         self.assertEqual(2, result.exit_code)
-        self.assertFalse(mock_write_json.called)
-        mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
+        self.assertFalse(mock_commit.called)
+        self.assertFalse(mock_lock.called)
 
     def test_sleep(self):
         runner = click.testing.CliRunner()
@@ -201,15 +441,17 @@ class TestModule(unittest.TestCase):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
               ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
-              ), unittest.mock.patch('grocery._write_json', mock_write_json
+              ), unittest.mock.patch('grocery._commit', mock_commit
               ):
             result = runner.invoke(module_ut.cart, ['remove', '3'])
-        mock_lock.assert_called_once_with('grocery cart lock', timeout=5)
+        self.assertFalse(mock_lock.called)
         self.assertEqual(2, result.exit_code)
-        self.assertFalse(mock_write_json.called)
+        self.assertFalse(mock_commit.called)
 
     def test_billing_prompt(self):
         runner = click.testing.CliRunner()
@@ -234,132 +476,515 @@ class TestModule(unittest.TestCase):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
         mock_read_json = mymock({})
-        mock_write_json = mymock(None)
+        mock_commit = mymock(None)
         mock_card_auth = mymock(None)
         mock_view = mymock(None)
+        mock_append_order = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mymock(MANIFEST)
                   ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                   ), unittest.mock.patch('grocery._card_auth', mock_card_auth
                   ), unittest.mock.patch('grocery._view', mock_view
-                  ), unittest.mock.patch('grocery._write_json', mock_write_json
+                  ), unittest.mock.patch('grocery._commit', mock_commit
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ), unittest.mock.patch('grocery._append_order',
+                      mock_append_order
                   ):
             result = runner.invoke(module_ut.cart, ['checkout', 'card'],
                     input='1111222233334567\n123\n0719\n97330\nfake addy\ny\n')
         self.assertFalse(mock_card_auth.called)
-        self.assertFalse(mock_write_json.called)
-        self.assertTrue(mock_lock.called)
+        self.assertFalse(mock_commit.called)
+        self.assertFalse(mock_append_order.called)
+        self.assertFalse(mock_lock.called)
         self.assertEqual(0, result.exit_code)
 
     def test_card_payment_abort(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
-        mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_read_json = mymock(CART)
+        mock_commit = mymock(None)
         mock_card_auth = mymock(None)
         mock_view = mymock(None)
+        mock_append_order = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mymock(MANIFEST)
                   ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                   ), unittest.mock.patch('grocery._card_auth', mock_card_auth
                   ), unittest.mock.patch('grocery._view', mock_view
-                  ), unittest.mock.patch('grocery._write_json', mock_write_json
+                  ), unittest.mock.patch('grocery._commit', mock_commit
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ), unittest.mock.patch('grocery._append_order',
+                      mock_append_order
                   ):
             result = runner.invoke(module_ut.cart, ['checkout', 'card'],
                     input='1111222233334567\n123\n0719\n97330\nfake addy\nn\n')
         mock_card_auth.assert_called_once_with('1111222233334567', '123', '0719',
             '97330')
-        self.assertFalse(mock_write_json.called)
+        self.assertFalse(mock_commit.called)
+        self.assertFalse(mock_append_order.called)
         mock_view.assert_called_once_with(True, 'ID',
-                data={1: _.row_a, 2: _.row_b})
-        self.assertTrue(mock_lock.called)
+                data=CART,
+                read_products=unittest.mock.ANY)
+        self.assertFalse(mock_lock.called)
         self.assertEqual(0, result.exit_code)
 
     def test_paypal_payment_no_addy(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
-        mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_read_json = mymock(CART)
+        mock_commit = mymock(None)
         mock_card_auth = mymock(None)
         mock_view = mymock(None)
+        mock_append_order = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mymock(MANIFEST)
                   ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                   ), unittest.mock.patch('grocery._card_auth', mock_card_auth
                   ), unittest.mock.patch('grocery._view', mock_view
-                  ), unittest.mock.patch('grocery._write_json', mock_write_json
+                  ), unittest.mock.patch('grocery._commit', mock_commit
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ), unittest.mock.patch('grocery._append_order',
+                      mock_append_order
                   ):
             result = runner.invoke(module_ut.cart, ['checkout', 'paypal'],
                     input='cameron@cameronpallen.com\nn\nfake address\ny\n')
-        mock_write_json.assert_called_once_with({}, True)
+        mock_commit.assert_called_once_with(MANIFEST, {True: {}})
+        self.assertTrue(mock_append_order.called)
         self.assertFalse(mock_card_auth.called)
         mock_view.assert_called_once_with(True, 'ID',
-                data={1: _.row_a, 2: _.row_b})
+                data=CART,
+                read_products=unittest.mock.ANY)
         self.assertTrue(mock_lock.called)
         self.assertEqual(0, result.exit_code)
 
     def test_paypal_payment(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
-        mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_read_json = mymock(CART)
+        mock_commit = mymock(None)
         mock_card_auth = mymock(None)
         mock_view = mymock(None)
+        mock_append_order = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mymock(MANIFEST)
                   ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                   ), unittest.mock.patch('grocery._card_auth', mock_card_auth
                   ), unittest.mock.patch('grocery._view', mock_view
-                  ), unittest.mock.patch('grocery._write_json', mock_write_json
+                  ), unittest.mock.patch('grocery._commit', mock_commit
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ), unittest.mock.patch('grocery._append_order',
+                      mock_append_order
                   ):
             result = runner.invoke(module_ut.cart, ['checkout', 'paypal'],
                     input='cameron@cameronpallen.com\ny\ny\n')
-        mock_write_json.assert_called_once_with({}, True)
+        mock_commit.assert_called_once_with(MANIFEST, {True: {}})
+        self.assertTrue(mock_append_order.called)
         self.assertFalse(mock_card_auth.called)
         mock_view.assert_called_once_with(True, 'ID',
-                data={1: _.row_a, 2: _.row_b})
+                data=CART,
+                read_products=unittest.mock.ANY)
         self.assertTrue(mock_lock.called)
         self.assertEqual(0, result.exit_code)
 
     def test_card_payment(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
-        mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_read_json = mymock(CART)
+        mock_commit = mymock(None)
         mock_card_auth = mymock(None)
         mock_view = mymock(None)
+        mock_append_order = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mymock(MANIFEST)
                   ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                   ), unittest.mock.patch('grocery._card_auth', mock_card_auth
                   ), unittest.mock.patch('grocery._view', mock_view
-                  ), unittest.mock.patch('grocery._write_json', mock_write_json
+                  ), unittest.mock.patch('grocery._commit', mock_commit
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ), unittest.mock.patch('grocery._append_order',
+                      mock_append_order
+                  ), unittest.mock.patch('grocery.uuid.uuid4',
+                      mymock(unittest.mock.Mock(hex='nonce'))
                   ):
             result = runner.invoke(module_ut.cart, ['checkout', 'card'],
                     input='1111222233334567\n123\n0719\n97330\nfake addy\ny\n')
         mock_card_auth.assert_called_once_with('1111222233334567', '123', '0719',
             '97330')
-        mock_write_json.assert_called_once_with({}, True)
+        mock_commit.assert_called_once_with(MANIFEST, {True: {}})
+        mock_append_order.assert_called_once_with({
+            'order_id': module_ut._order_id(MANIFEST),
+            'time': unittest.mock.ANY,
+            'method': 'card', 'authorization': 'local-nonce',
+            'shipping_address': 'fake addy', 'total_cents': 2199,
+            'items': [
+                {'id': 1, 'name': 'pizza', 'units': 'pies', 'quantity': 2.0,
+                 'price_cents': 600, 'subtotal_cents': 1200},
+                {'id': 2, 'name': 'wine', 'units': 'bottles', 'quantity': 1.0,
+                 'price_cents': 999, 'subtotal_cents': 999},
+            ]})
         mock_view.assert_called_once_with(True, 'ID',
-                data={1: _.row_a, 2: _.row_b})
+                data=CART,
+                read_products=unittest.mock.ANY)
         self.assertTrue(mock_lock.called)
         self.assertEqual(0, result.exit_code)
 
     def test_card_payment_bad_month(self):
         runner = click.testing.CliRunner()
         mock_lock = unittest.mock.MagicMock()
-        mock_read_json = mymock({1: _.row_a, 2: _.row_b})
-        mock_write_json = mymock(None)
+        mock_read_json = mymock(CART)
+        mock_commit = mymock(None)
         mock_card_auth = mymock(None)
         mock_view = mymock(None)
+        mock_append_order = mymock(None)
         with unittest.mock.patch('grocery._read_json', mock_read_json
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mymock(MANIFEST)
                   ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
                   ), unittest.mock.patch('grocery._card_auth', mock_card_auth
                   ), unittest.mock.patch('grocery._view', mock_view
-                  ), unittest.mock.patch('grocery._write_json', mock_write_json
+                  ), unittest.mock.patch('grocery._commit', mock_commit
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ), unittest.mock.patch('grocery._append_order',
+                      mock_append_order
                   ):
             result = runner.invoke(module_ut.cart, ['checkout', 'card'],
                     input='1111222233334567\n123\n2119\n97330\nfake addy\ny\n')
         self.assertFalse(mock_card_auth.called)
-        self.assertFalse(mock_write_json.called)
-        self.assertTrue(mock_lock.called)
+        self.assertFalse(mock_commit.called)
+        self.assertFalse(mock_append_order.called)
+        self.assertFalse(mock_lock.called)
         self.assertEqual(2, result.exit_code)
 
+    def test_place_order(self):
+        mock_lock = unittest.mock.MagicMock()
+        mock_commit = mymock(None)
+        record = {'order_id': 'abc'}
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch('grocery.ilock.ILock', mock_lock), \
+                unittest.mock.patch('grocery._commit', mock_commit), \
+                unittest.mock.patch('grocery.ORDERS_PATH',
+                    os.path.join(directory, 'orders.jsonl')):
+            with unittest.mock.patch('grocery._read_manifest',
+                    mymock(MANIFEST)):
+                self.assertTrue(module_ut._place_order(MANIFEST, record))
+                # Retrying doesn't record the order twice.
+                self.assertFalse(module_ut._place_order(MANIFEST, record))
+            changed = dict(MANIFEST, cart='cart.4.json')
+            with unittest.mock.patch('grocery._read_manifest',
+                    mymock(changed)):
+                self.assertFalse(module_ut._place_order(MANIFEST, record))
+                with self.assertRaises(module_ut.ConflictError):
+                    module_ut._place_order(MANIFEST, {'order_id': 'def'})
+            self.assertEqual([record], list(module_ut._read_orders()))
+        self.assertEqual([unittest.mock.call(MANIFEST, {True: {}})] * 2,
+            mock_commit.call_args_list)
+
+    def test_read_recent_orders(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch('grocery.ORDERS_PATH',
+                    os.path.join(directory, 'orders.jsonl')):
+            self.assertEqual([], list(module_ut._read_recent_orders()))
+            records = [{'order_id': str(idx)} for idx in range(100)]
+            for record in records:
+                module_ut._append_order(record)
+            line = len(json.dumps(records[-1])) + 1
+            self.assertEqual(records[-3:],
+                list(module_ut._read_recent_orders(3 * line)))
+            self.assertEqual(records[-3:],
+                list(module_ut._read_recent_orders(3 * line + 1)))
+            self.assertEqual(records,
+                list(module_ut._read_recent_orders()))
+
+    def test_checkout_retry_new_key(self):
+        runner = click.testing.CliRunner()
+        mock_adapter = unittest.mock.Mock(spec=module_ut.PaymentAdapter)
+        mock_adapter.authorize = unittest.mock.AsyncMock(return_value='auth')
+        mock_adapter.void = unittest.mock.AsyncMock(return_value=None)
+        with unittest.mock.patch('grocery._read_json', mymock(CART)
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mymock(MANIFEST)
+                  ), unittest.mock.patch('grocery.PAYMENT_ADAPTER',
+                      mock_adapter
+                  ), unittest.mock.patch('grocery._view', mymock(None)
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ):
+            # Abandon the checkout, then check out the same cart again.
+            for _attempt in range(2):
+                result = runner.invoke(module_ut.cart, ['checkout', 'paypal'],
+                        input='cameron@cameronpallen.com\ny\nn\n')
+                self.assertEqual(0, result.exit_code)
+        first, second = [call[0][:2]
+            for call in mock_adapter.authorize.await_args_list]
+        # Same order, but the provider sees a new key for each attempt.
+        self.assertEqual(first[0], second[0])
+        self.assertNotEqual(first[1], second[1])
+        self.assertEqual(2, mock_adapter.void.await_count)
+
+    def test_checkout_rerun_after_failure(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.MagicMock()
+        mock_adapter = unittest.mock.Mock(spec=module_ut.PaymentAdapter)
+        mock_adapter.authorize = unittest.mock.AsyncMock(return_value='auth')
+        mock_adapter.void = unittest.mock.AsyncMock(return_value=None)
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch('grocery.ilock.ILock', mock_lock), \
+                unittest.mock.patch('grocery.PAYMENT_ADAPTER', mock_adapter), \
+                unittest.mock.patch('grocery.MANIFEST_PATH',
+                    os.path.join(directory, '.grocery_manifest.json')), \
+                unittest.mock.patch('grocery.ORDERS_PATH',
+                    os.path.join(directory, 'orders.jsonl')):
+            with module_ut.Session() as session:
+                session.cart.add('wine', 'bottles', 9.99, 2)
+            # The order is recorded, but emptying the cart fails.
+            with unittest.mock.patch('grocery._commit',
+                    unittest.mock.Mock(spec=[], side_effect=OSError)):
+                result = runner.invoke(module_ut.cart, ['checkout', 'paypal'],
+                        input='cameron@cameronpallen.com\ny\ny\n')
+            self.assertNotEqual(0, result.exit_code)
+            self.assertEqual(1, len(list(module_ut._read_orders())))
+            # Checking out again only finishes the recorded order.
+            result = runner.invoke(module_ut.cart, ['checkout', 'paypal'])
+            self.assertEqual(0, result.exit_code)
+            self.assertEqual('This order has already been placed.\n'
+                'Cart cleared.\n', result.output)
+            self.assertEqual({}, module_ut.Session().cart.items())
+            self.assertEqual(1, len(list(module_ut._read_orders())))
+        self.assertEqual(1, mock_adapter.authorize.await_count)
+        self.assertFalse(mock_adapter.void.called)
+
+    def test_checkout_conflict(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.MagicMock()
+        mock_adapter = unittest.mock.Mock(spec=module_ut.PaymentAdapter)
+        mock_adapter.authorize = unittest.mock.AsyncMock(return_value='auth')
+        mock_adapter.void = unittest.mock.AsyncMock(return_value=None)
+        mock_read_manifest = unittest.mock.Mock(spec=[],
+            side_effect=[MANIFEST, dict(MANIFEST, cart='cart.4.json')])
+        mock_commit = mymock(None)
+        with unittest.mock.patch('grocery._read_json', mymock(CART)
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mock_read_manifest
+                  ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+                  ), unittest.mock.patch('grocery.PAYMENT_ADAPTER',
+                      mock_adapter
+                  ), unittest.mock.patch('grocery._view', mymock(None)
+                  ), unittest.mock.patch('grocery._commit', mock_commit
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ), unittest.mock.patch('grocery.uuid.uuid4',
+                      mymock(unittest.mock.Mock(hex='nonce'))
+                  ):
+            result = runner.invoke(module_ut.cart, ['checkout', 'paypal'],
+                    input='cameron@cameronpallen.com\ny\ny\n')
+        self.assertEqual(1, result.exit_code)
+        mock_adapter.authorize.assert_awaited_once_with(
+            module_ut._order_id(MANIFEST), 'nonce', 2199, 'paypal',
+            {'email': 'cameron@cameronpallen.com'})
+        mock_adapter.void.assert_awaited_once_with('auth')
+        self.assertFalse(mock_commit.called)
+
+    def test_checkout_lock_timeout(self):
+        runner = click.testing.CliRunner()
+        mock_lock = unittest.mock.Mock(spec=[],
+            side_effect=module_ut.ilock.ILockException)
+        mock_adapter = unittest.mock.Mock(spec=module_ut.PaymentAdapter)
+        mock_adapter.authorize = unittest.mock.AsyncMock(return_value='auth')
+        mock_adapter.void = unittest.mock.AsyncMock(return_value=None)
+        mock_commit = mymock(None)
+        with unittest.mock.patch('grocery._read_json', mymock(CART)
+                  ), unittest.mock.patch('grocery._read_manifest',
+                      mymock(MANIFEST)
+                  ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+                  ), unittest.mock.patch('grocery.PAYMENT_ADAPTER',
+                      mock_adapter
+                  ), unittest.mock.patch('grocery._view', mymock(None)
+                  ), unittest.mock.patch('grocery._commit', mock_commit
+                  ), unittest.mock.patch('grocery._read_recent_orders',
+                      mymock([])
+                  ):
+            result = runner.invoke(module_ut.cart, ['checkout', 'paypal'],
+                    input='cameron@cameronpallen.com\ny\ny\n')
+        self.assertEqual(1, result.exit_code)
+        self.assertIn('Unable to acquire grocery cart lock', result.output)
+        mock_adapter.void.assert_awaited_once_with('auth')
+        self.assertFalse(mock_commit.called)
+
+    def test_orders(self):
+        runner = click.testing.CliRunner()
+        records = [{'order_id': 'abc', 'time': 0, 'method': 'card',
+            'items': [{}, {}], 'total_cents': 2199}]
+        with unittest.mock.patch('grocery._read_orders', mymock(records)
+                  ), unittest.mock.patch('grocery.time.localtime',
+                      lambda seconds: time.gmtime(seconds)
+                  ):
+            result = runner.invoke(module_ut.cart, ['orders'])
+            json_result = runner.invoke(module_ut.cart,
+                ['orders', '--format', 'json'])
+        self.assertEqual(
+            ' Order ID | Date             | Method | Items | Total \n'
+            '------------------------------------------------------\n'
+            ' abc      | 1970-01-01 00:00 | card   | 2     | $21.99\n',
+            result.output
+        )
+        self.assertEqual(records, json.loads(json_result.output))
+
+    def test_session(self):
+        mock_read_json = unittest.mock.Mock(spec=[],
+          side_effect=lambda cart, manifest: (
+              {0: {'product_id': 0, 'Quantity': 1000}} if cart else
+              {0: {'Name': 'bread', 'Unit of Measure': 'loafs', 'Price': 325}})
+        )
+        mock_commit = mymock(None)
+        with unittest.mock.patch('grocery._read_json', mock_read_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
+              ), unittest.mock.patch('grocery._commit', mock_commit
+              ):
+            with module_ut.Session() as session:
+                product_id = session.store.add('wine', 'bottles', 9.99)
+                item_id = session.store.to_cart(product_id, 2)
+                session.cart.update_quantity(0, 1.5)
+                self.assertEqual(2486, session.cart.total())
+                self.assertFalse(mock_commit.called)
+        self.assertEqual((1, 1), (product_id, item_id))
+        self.assertEqual(2, len(mock_read_json.call_args_list))
+        mock_commit.assert_called_once_with(MANIFEST, {
+            False: {
+                0: {'Name': 'bread', 'Unit of Measure': 'loafs',
+                    'Price': 325},
+                1: {'Name': 'wine', 'Unit of Measure': 'bottles',
+                    'Price': 999}},
+            True: {
+                0: {'product_id': 0, 'Quantity': 1500},
+                1: {'product_id': 1, 'Quantity': 2000}},
+        })
+
+    def test_session_error(self):
+        mock_read_json = unittest.mock.Mock(spec=[],
+          side_effect=lambda cart, manifest: {1: _.row_a, 2: _.row_b})
+        mock_commit = mymock(None)
+        with unittest.mock.patch('grocery._read_json', mock_read_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mymock(MANIFEST)
+              ), unittest.mock.patch('grocery._commit', mock_commit
+              ):
+            with self.assertRaises(click.BadParameter):
+                with module_ut.Session() as session:
+                    session.cart.remove(1)
+                    session.cart.remove(3)
+            session = module_ut.Session()
+            session.cart.remove(1)
+            session.rollback()
+            self.assertEqual({1: _.row_a, 2: _.row_b}, session.cart.items())
+            session.commit()
+        self.assertFalse(mock_commit.called)
+
+    def test_snapshot(self):
+        mock_lock = unittest.mock.MagicMock()
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch('grocery.ilock.ILock', mock_lock), \
+                unittest.mock.patch('grocery.MANIFEST_PATH',
+                    os.path.join(directory, '.grocery_manifest.json')):
+            # Files from before versioning are read as version 0.
+            with open(os.path.join(directory, '.grocery_cart.json'), 'w'
+                    ) as filehandle:
+                json.dump({'0': {'product_id': 0, 'Quantity': 2.0}},
+                    filehandle)
+            reader = module_ut.Session()
+            self.assertEqual({0: {'product_id': 0, 'Quantity': 2000}},
+                reader.cart.items())
+            for price in (1, 2, 3):
+                with module_ut.Session() as session:
+                    session.store.add('bread', 'loafs', price)
+                    session.cart.update_quantity(0, price)
+            # The reader keeps its snapshot, including for files it hadn't
+            #   read yet.
+            self.assertEqual({}, reader.store.items())
+            self.assertEqual({'version': 3,
+                    'cart': '.grocery_cart.3.json',
+                    'products': '.store_products.3.json',
+                    'epoch': unittest.mock.ANY},
+                module_ut._read_manifest())
+            self.assertEqual(['.grocery_cart.2.json', '.grocery_cart.3.json',
+                    '.grocery_cart.json', '.grocery_manifest.json',
+                    '.store_products.2.json', '.store_products.3.json'],
+                sorted(os.listdir(directory)))
+            session = module_ut.Session()
+            self.assertEqual(300, session.cart.total())
+            with self.assertRaises(module_ut.ConflictError):
+                reader.cart.empty()
+                reader.commit()
+
+    def test_snapshot_expired(self):
+        mock_lock = unittest.mock.MagicMock()
+        with tempfile.TemporaryDirectory() as directory, \
+                unittest.mock.patch('grocery.ilock.ILock', mock_lock), \
+                unittest.mock.patch('grocery.MANIFEST_PATH',
+                    os.path.join(directory, '.grocery_manifest.json')):
+            with module_ut.Session() as session:
+                session.cart.add('bread', 'loafs', 1)
+            snapshot = module_ut._read_manifest()
+            self.assertEqual('.store_products.1.json', snapshot['products'])
+            reader = module_ut.Session()
+            reader.cart.items()
+            for price in (2, 3):
+                with module_ut.Session() as session:
+                    session.store.add('wine', 'bottles', price)
+            # Version 1 has been cleaned up, but the reader already has both
+            #   of its files in memory.
+            self.assertNotIn('.store_products.1.json', os.listdir(directory))
+            self.assertEqual({0: {'Name': 'bread', 'Unit of Measure': 'loafs',
+                'Price': 100}}, reader.store.items())
+            self.assertEqual(100, reader.cart.total())
+            # Reading a cleaned up version fails rather than seeing it empty.
+            with self.assertRaises(module_ut.ConflictError):
+                module_ut._read_json(False, snapshot)
+            # Starting over reads the current version.
+            manifests = [snapshot, module_ut._read_manifest()]
+            with unittest.mock.patch('grocery._read_manifest',
+                    lambda: manifests.pop(0)):
+                self.assertEqual(3, len(module_ut._transaction(
+                    lambda session: session.store.items())))
+
+    def test_transaction_retry(self):
+        mock_lock = unittest.mock.MagicMock()
+        manifests = [MANIFEST, dict(MANIFEST, version=4),
+            dict(MANIFEST, version=4), dict(MANIFEST, version=4)]
+        mock_read_manifest = unittest.mock.Mock(spec=[],
+            side_effect=lambda: manifests.pop(0))
+        mock_commit = mymock(None)
+        mock_read_json = unittest.mock.Mock(spec=[],
+          side_effect=lambda cart, manifest: {1: _.row_a, 2: _.row_b})
+        with unittest.mock.patch('grocery._read_json', mock_read_json
+              ), unittest.mock.patch('grocery._read_manifest',
+                  mock_read_manifest
+              ), unittest.mock.patch('grocery._commit', mock_commit
+              ), unittest.mock.patch('grocery.ilock.ILock', mock_lock
+              ):
+            module_ut._transaction(lambda session: session.cart.remove(1))
+        mock_commit.assert_called_once_with(dict(MANIFEST, version=4),
+            {True: {2: _.row_b}})
+
+    def test_payment_adapter_abstract(self):
+        class Incomplete(module_ut.PaymentAdapter):
+            async def authorize(self, order_id, amount, method, details):
+                return 'auth'
+        with self.assertRaises(TypeError):
+            Incomplete()
+        module_ut.LocalPaymentAdapter()
+
     def test_auth_card(self):
         module_ut._card_auth(_.number, _.code, _.expiry, _.zip)
 
@@ -7,6 +7,7 @@ setup(
     install_requires=[
         'click==6.7',
         'ilock==1.0.1',
+        'numpy>=1.13',
     ],
     entry_points='''
         [console_scripts]